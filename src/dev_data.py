@@ -1,5 +1,7 @@
+import functools
 import os
 
+import numpy as np
 import pandas as pd
 
 import config
@@ -12,14 +14,40 @@ labels) to ensure maximum training size among  stratified and balanced classes
 given audio segmentation challenges.
 """
 
-df_train = pd.read_csv(
-    os.path.join(
-        config.BASE_DIR, "data", "labels", "train_split_Depression_AVEC2017.csv"
+LABEL_FILES = [
+    os.path.join(config.BASE_DIR, "data", "labels", csv_name)
+    for csv_name in (
+        "train_split_Depression_AVEC2017.csv",
+        "dev_split_Depression_AVEC2017.csv",
     )
-)
+]
+LABEL_COLUMNS = ["Participant_ID", "PHQ8_Binary", "PHQ8_Score", "Gender"]
+LABEL_DTYPES = {
+    "Participant_ID": np.int32,
+    "PHQ8_Binary": np.int8,
+    "PHQ8_Score": np.int8,
+    "Gender": np.int8,
+}
 
-df_test = pd.read_csv(
-    os.path.join(config.BASE_DIR, "data", "labels", "dev_split_Depression_AVEC2017.csv")
-)
 
-df_dev = pd.concat([df_train, df_test], axis=0)
+def read_labels(csv_file):
+    """
+    Reads the label columns of one of AVEC's split csv files.
+    """
+    return pd.read_csv(
+        csv_file,
+        usecols=LABEL_COLUMNS,
+        dtype=LABEL_DTYPES,
+        engine="c",
+    )
+
+
+@functools.lru_cache(maxsize=1)
+def load_dev_labels():
+    """
+    Returns the development dataframe, the train and dev splits combined.
+    The csv files are parsed on the first call only.
+    """
+    return pd.concat(
+        [read_labels(csv_file) for csv_file in LABEL_FILES], axis=0, ignore_index=True
+    )
@@ -1,12 +1,15 @@
+import itertools
 import os
-import random
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
+from numpy.lib.format import open_memmap
+from numpy.lib.stride_tricks import sliding_window_view
 
 import config
-from spectrogram_dicts import build_class_dictionaries
+from spectrogram_dicts import cached_class_dictionaries
 
-np.random.seed(15)  # for reproducibility
+rng = np.random.default_rng(15)  # for reproducibility
 
 
 """
@@ -42,6 +45,8 @@ def determine_num_crops(depressed_dict, normal_dict, crop_width=125):
         a dictionary of depressed participants with the participant id as the
         key and the segmented and concatenated matrix representation of
         their spectrograms as the values.
+    normal_dict : dictionary
+        the same for the non-depressed participants.
     crop_width : integer
         the desired pixel width of the crop samples
         (125 pixels = 4 seconds of audio)
@@ -52,17 +57,27 @@ def determine_num_crops(depressed_dict, normal_dict, crop_width=125):
         the maximum number of samples that should be sampled from each clip
         to ensure balanced classes can be built.
     """
-    merged_dict = {**normal_dict, **depressed_dict}
-    shortest_clip = min(merged_dict.items(), key=lambda x: x[1].shape[1])
-    shortest_pixel_width = shortest_clip[1].shape[1]
-    num_samples_from_clips = shortest_pixel_width // crop_width
+    pixel_widths = np.fromiter(
+        (
+            mat.shape[1]
+            for mat in itertools.chain(normal_dict.values(), depressed_dict.values())
+        ),
+        dtype=np.int64,
+        count=len(normal_dict) + len(depressed_dict),
+    )
+    num_samples_from_clips = int(pixel_widths.min()) // crop_width
     return num_samples_from_clips
 
 
-def build_class_sample_dict(segmented_audio_dict, n_samples, crop_width):
+def write_class_samples(segmented_audio_dict, n_samples, crop_width, rng, out, scales):
     """
-    Get N (num_samples) pseudo random non-overlapping samples from the all
-    the depressed participants.
+    Get N (num_samples) pseudo random non-overlapping samples from each
+    participant of a class and write them, quantized, straight into out.
+    The crops of each participant are extracted in a separate thread, numpy
+    releases the GIL while copying them out of the (memory-mapped) matrices.
+    Up to os.cpu_count() participants are processed at once, so peak memory
+    is about that many participants' worth of float32 crops plus the
+    crop-sized temporaries of quantize_crops.
 
     Parameters
     ----------
@@ -75,163 +90,261 @@ def build_class_sample_dict(segmented_audio_dict, n_samples, crop_width):
     crop_width : integer
         the desired pixel width of the crop samples
         (125 pixels = 4 seconds of audio)
-
-    Returns
-    -------
-    class sample dict : dictionary
-        a dictionary of a class of participants with keys of participant ids
-        and values of a list of the cropped samples from the spectrogram
-        matrices. The lists are n_samples long and the entries within the
-        list have dimension (numFrequencyBins * crop_width)
+    rng : numpy.random.Generator
+        seeded random generator used to pick the crops
+    out : ndarray
+        uint8 array of shape (n_participants * n_samples, numFrequencyBins,
+        crop_width), usually a memory-mapped shard. The participant with the
+        i-th smallest id is written to out[i * n_samples : (i + 1) * n_samples].
+    scales : ndarray
+        float32 array of shape (n_participants * n_samples, 2) receiving the
+        quantization offset and scale of each crop (see quantize_crops)
+    """
+    # every participant gets its own child generator seeded by the participant
+    # id, so the crops depend neither on the dict order nor on the order the
+    # threads run in
+    seed = int(rng.integers(2**63))
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = []
+        for i, partic_id in enumerate(sorted(segmented_audio_dict)):
+            cursor = i * n_samples
+            futures.append(
+                executor.submit(
+                    write_random_samples,
+                    segmented_audio_dict[partic_id],
+                    n_samples,
+                    crop_width,
+                    np.random.default_rng([seed, partic_id]),
+                    out[cursor : cursor + n_samples],
+                    scales[cursor : cursor + n_samples],
+                )
+            )
+        for future in futures:
+            future.result()
+
+
+def write_random_samples(matrix, n_samples, crop_width, rng, out, scales):
+    """
+    Quantizes the random samples of get_random_samples into out, and their
+    offsets and scales into scales.
     """
-    class_samples_dict = dict()
-    for partic_id, clip_mat in segmented_audio_dict.items():
-        samples = get_random_samples(clip_mat, n_samples, crop_width)
-        class_samples_dict[partic_id] = samples
-    return class_samples_dict
+    quantized, crop_scales = quantize_crops(
+        get_random_samples(matrix, n_samples, crop_width, rng)
+    )
+    out[:] = quantized
+    scales[:] = crop_scales
 
 
-def get_random_samples(matrix, n_samples, crop_width):
+def get_random_samples(matrix, n_samples, crop_width, rng):
     """
     Get N random samples with width of crop_width from the numpy matrix
-    representing the participant's audio spectrogram.
+    representing the participant's audio spectrogram, as a single
+    contiguous float32 (n_samples, numFrequencyBins, crop_width) array
+    whatever the dtype and layout of the input matrix.
     """
-    # crop full spectrogram into segments of width = crop_width
+    # crop full spectrogram into segments of width = crop_width, as a
+    # strided view of shape (n_splits, numFrequencyBins, crop_width)
     clipped_mat = matrix[:, (matrix.shape[1] % crop_width) :]
-    n_splits = clipped_mat.shape[1] / crop_width
-    cropped_sample_ls = np.split(clipped_mat, n_splits, axis=1)
+    windows = sliding_window_view(clipped_mat, crop_width, axis=1)[:, ::crop_width]
+    windows = windows.transpose(1, 0, 2)
 
     # get random samples
-    samples = random.sample(cropped_sample_ls, n_samples)
-    return samples
+    idx = rng.choice(windows.shape[0], size=n_samples, replace=False)
+    return np.ascontiguousarray(windows[idx], dtype=np.float32)
 
 
-def create_sample_dicts(crop_width):
+def create_sample_dicts(crop_width, rng):
     """
-    Utilizes the above function to return two dictionaries, depressed
-    and normal. Each dictionary has only participants in the specific class,
-    with participant ids as key, a values of a list of the cropped samples
-    from the spectrogram matrices. The lists are vary in length depending
-    on the length of the interview clip. The entries within the list are
-    numpy arrays with dimennsion (513, 125).
+    Utilizes the above functions to write two class shards, depressed
+    and normal. Each shard has only participants in the specific class,
+    with n_samples cropped samples from each participant's spectrogram
+    matrix, n_samples being limited by the shortest interview clip. The
+    crops have dimennsion (513, 125) and are picked with the numpy random
+    generator rng.
     """
     # build dictionaries of participants and segmented audio matrix
-    depressed_dict, normal_dict = build_class_dictionaries(
+    depressed_dict, normal_dict = cached_class_dictionaries(
         os.path.join(config.BASE_DIR, "data", "interim")
     )
     n_samples = determine_num_crops(depressed_dict, normal_dict, crop_width=crop_width)
-    # get n_sample random samples from each depressed participant
-    depressed_samples = build_class_sample_dict(depressed_dict, n_samples, crop_width)
-    # get n_sample random samples from each non-depressed participant
-    normal_samples = build_class_sample_dict(normal_dict, n_samples, crop_width)
-    # iterate through samples dictionaries and save a npz file
-    # with the radomly sleected n_samples for each participant.
-    # save arrays to .npz
+    # save one shard per class holding n_sample random samples from each
+    # participant, along with the participant id of each crop
     path = os.path.join(config.BASE_DIR, "data", "processed")
-    for key, values in depressed_samples.items():
-        np.savez(os.path.join(path, f"D{key}.npz"), *values)
-    for key, values in normal_samples.items():
-        np.savez(os.path.join(path, f"N{key}.npz"), *values)
+    save_class_shard(depressed_dict, n_samples, crop_width, rng, path, "D")
+    save_class_shard(normal_dict, n_samples, crop_width, rng, path, "N")
+
+
+def save_class_shard(segmented_audio_dict, n_samples, crop_width, rng, path, prefix):
+    """
+    Saves the crops of a class of participants as a single contiguous
+    (n_crops, 513, crop_width) uint8 array in <prefix>_shard.npy, the
+    quantization offset and scale of each crop in <prefix>_scale.npy and the
+    participant id of each crop in <prefix>_pid.npy. All are uncompressed
+    .npy files so they can be memory-mapped when loaded. The shard is opened
+    as a memory map and the crops are streamed into it participant by
+    participant (see write_class_samples for the peak memory), instead of
+    stacking the whole class in memory first.
+    """
+    n_crops = len(segmented_audio_dict) * n_samples
+    n_bins = next(iter(segmented_audio_dict.values())).shape[0]
+    shard = open_memmap(
+        os.path.join(path, f"{prefix}_shard.npy"),
+        mode="w+",
+        dtype=np.uint8,
+        shape=(n_crops, n_bins, crop_width),
+    )
+    scales = np.empty((n_crops, 2), dtype=np.float32)
+    write_class_samples(segmented_audio_dict, n_samples, crop_width, rng, shard, scales)
+    shard.flush()
+    pids = np.repeat(np.asarray(sorted(segmented_audio_dict)), n_samples)
+    np.save(os.path.join(path, f"{prefix}_scale.npy"), scales)
+    np.save(os.path.join(path, f"{prefix}_pid.npy"), pids)
 
 
-def rand_samp_train_test_split(npz_file_dir):
+def quantize_crops(crops):
+    """
+    Quantizes each crop linearly between its min and max to uint8, a quarter
+    of the float32 size. The crops are min-max normalized before training
+    anyway (see cnn.prep_train_test), so only the rounding is lost.
+
+    Returns
+    -------
+    quantized : ndarray
+        uint8 array with the shape of crops
+    scales : ndarray
+        float32 array of shape (n_crops, 2) with the offset (min) and scale
+        of each crop, such that crop ~ quantized * scale + offset.
+    """
+    mins = crops.min(axis=(1, 2))
+    steps = (crops.max(axis=(1, 2)) - mins) / 255
+    steps[steps == 0] = 1  # constant crops
+    normalized = (crops - mins[:, None, None]) / steps[:, None, None]
+    scales = np.stack((mins, steps), axis=1).astype(np.float32)
+    return np.rint(normalized).astype(np.uint8), scales
+
+
+def dequantize_crops(quantized, scales, idx, out):
+    """
+    Restores the float32 crops at positions idx of a quantized shard into out.
+    """
+    out[:] = quantized[idx]
+    out *= scales[idx, 1][:, None, None]
+    out += scales[idx, 0][:, None, None]
+
+
+def load_class_shard(path, prefix):
+    """
+    Returns the memory-mapped quantized crops of a class shard, their
+    quantization scales and the participant id of each crop.
+    """
+    shard = np.load(os.path.join(path, f"{prefix}_shard.npy"), mmap_mode="r")
+    scales = np.load(os.path.join(path, f"{prefix}_scale.npy"))
+    pids = np.load(os.path.join(path, f"{prefix}_pid.npy"))
+    return shard, scales, pids
+
+
+def gather_samples(*class_selections):
+    """
+    Restores the crops of the selected participants of each class into a
+    single preallocated float32 array. Each selection is a
+    (shard, scales, pids, selected_ids, label) tuple, the first three as
+    returned by load_class_shard.
+    """
+    n_total = sum(np.isin(pids, ids).sum() for _, _, pids, ids, _ in class_selections)
+    samples = np.empty((n_total,) + class_selections[0][0].shape[1:], np.float32)
+    labels = np.empty(n_total, dtype=np.int8)
+    cursor = 0
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for selection in class_selections:
+            cursor = collect_samples(executor, selection, samples, labels, cursor)
+    return samples, labels
+
+
+def collect_samples(executor, selection, out_x, out_y, cursor):
+    """
+    Restores the crops of a class selection (see gather_samples) into out_x
+    starting at position cursor, and sets the matching entries of out_y to
+    the class label, so labels are correct by construction. Every
+    participant's crops are read from the memory-mapped shard in a separate
+    thread; numpy releases the GIL while copying, so the reads overlap.
+    Returns the position after the last written crop.
+    """
+    shard, scales, pids, ids, label = selection
+    futures = []
+    for partic_id in ids:
+        idx = np.flatnonzero(pids == partic_id)
+        out = out_x[cursor : cursor + len(idx)]
+        futures.append(executor.submit(dequantize_crops, shard, scales, idx, out))
+        out_y[cursor : cursor + len(idx)] = label
+        cursor += len(idx)
+    for future in futures:
+        future.result()
+    return cursor
+
+
+def rand_samp_train_test_split(shard_dir, rng):
     """
     Given the cropped segments from each class and particpant, this fucntion
-    determines how many samples we can draw from each particpant and how many
-    participants we can draw from each class.
+    determines how many participants we can draw from each class and splits
+    them into train and test sets.
 
     Parameters
     ----------
-    npz_file_dir : directory
-        directory contain the
-    crop_width : integer
-        the desired pixel width of the crop samples
-        (125 pixels = 4 seconds of audio)
+    shard_dir : directory
+        directory containing the class shards written by create_sample_dicts
+    rng : numpy.random.Generator
+        seeded random generator used to pick the participants
 
     Returns
     -------
-    num_samples_from_clips : int
-        the maximum number of samples that should be sampled from each clip
-        to ensure balanced classes can be built.
+    train_samples, train_labels, test_samples, test_labels : ndarrays
+        crops and labels (1 depressed, 0 normal) of the balanced train and
+        test sets.
     """
-    # files in directory
-    npz_files = os.listdir(npz_file_dir)
+    dep_shard, dep_scales, dep_pids = load_class_shard(shard_dir, "D")
+    norm_shard, norm_scales, norm_pids = load_class_shard(shard_dir, "N")
 
-    dep_samps = [f for f in npz_files if f.startswith("D")]
-    norm_samps = [f for f in npz_files if f.startswith("N")]
+    dep_ids = np.unique(dep_pids)
+    norm_ids = np.unique(norm_pids)
     # calculate how many samples to balance classes
-    max_samples = min(len(dep_samps), len(norm_samps))
+    max_samples = min(len(dep_ids), len(norm_ids))
 
     # randomly select max participants from each class without replacement
-    dep_select_samps = np.random.choice(dep_samps, size=max_samples, replace=False)
-    norm_select_samps = np.random.choice(norm_samps, size=max_samples, replace=False)
-
-    # randomly select n_samples_per_person (40 in the case of a crop width
-    # of 125) from each of the participant lists
+    dep_select_ids = rng.choice(dep_ids, size=max_samples, replace=False)
+    norm_select_ids = rng.choice(norm_ids, size=max_samples, replace=False)
 
-    # REFACTOR this code!
     test_size = 0.2
-    num_test_samples = int(len(dep_select_samps) * test_size)
-
-    train_samples = []
-    for sample in dep_select_samps[:-num_test_samples]:
-        npz_file = npz_file_dir + "/" + sample
-        with np.load(npz_file) as data:
-            for key in data.keys():
-                train_samples.append(data[key])
-    for sample in norm_select_samps[:-num_test_samples]:
-        npz_file = npz_file_dir + "/" + sample
-        with np.load(npz_file) as data:
-            for key in data.keys():
-                train_samples.append(data[key])
-    train_labels = np.concatenate(
-        (np.ones(len(train_samples) // 2), np.zeros(len(train_samples) // 2))
-    ).astype(int)
-
-    test_samples = []
-    for sample in dep_select_samps[-num_test_samples:]:
-        npz_file = npz_file_dir + "/" + sample
-        with np.load(npz_file) as data:
-            for key in data.keys():
-                test_samples.append(data[key])
-    for sample in norm_select_samps[-num_test_samples:]:
-        npz_file = npz_file_dir + "/" + sample
-        with np.load(npz_file) as data:
-            for key in data.keys():
-                test_samples.append(data[key])
-    test_labels = np.concatenate(
-        (np.ones(len(test_samples) // 2), np.zeros(len(test_samples) // 2))
-    ).astype(int)
-
-    return np.array(train_samples), train_labels, np.array(test_samples), test_labels
+    num_test_samples = int(len(dep_select_ids) * test_size)
+
+    train_samples, train_labels = gather_samples(
+        (dep_shard, dep_scales, dep_pids, dep_select_ids[:-num_test_samples], 1),
+        (norm_shard, norm_scales, norm_pids, norm_select_ids[:-num_test_samples], 0),
+    )
+    test_samples, test_labels = gather_samples(
+        (dep_shard, dep_scales, dep_pids, dep_select_ids[-num_test_samples:], 1),
+        (norm_shard, norm_scales, norm_pids, norm_select_ids[-num_test_samples:], 0),
+    )
+
+    return train_samples, train_labels, test_samples, test_labels
 
 
 if __name__ == "__main__":
-    # build participant's cropped npz files
+    # build the class shards of participant's cropped spectrograms
     # this is of the whole no_silence particpant's no_silence interview,
-    # but each array in the npz files was width of crop_width
-    create_sample_dicts(crop_width=125)
+    # but each array in the shards has width of crop_width
+    create_sample_dicts(crop_width=125, rng=rng)
 
-    # random sample from particpants npz files to ensure class balance
+    # random sample from particpants in the shards to ensure class balance
     train_samples, train_labels, test_samples, test_labels = rand_samp_train_test_split(
-        os.path.join(config.BASE_DIR, "data", "processed")
+        os.path.join(config.BASE_DIR, "data", "processed"), rng
     )
 
-    # save as npz locally
+    # save as npz locally, read back with d = np.load("split.npz"); d["train_x"]
     print("Saving npz file locally...")
     np.savez(
-        os.path.join(config.BASE_DIR, "data", "processed", "train_samples.npz"),
-        train_samples,
-    )
-    np.savez(
-        os.path.join(config.BASE_DIR, "data", "processed", "train_labels.npz"),
-        train_labels,
-    )
-    np.savez(
-        os.path.join(config.BASE_DIR, "data", "processed", "test_samples.npz"),
-        test_samples,
-    )
-    np.savez(
-        os.path.join(config.BASE_DIR, "data", "processed", "test_labels.npz"),
-        test_labels,
+        os.path.join(config.BASE_DIR, "data", "processed", "split.npz"),
+        train_x=train_samples,
+        train_y=train_labels,
+        test_x=test_samples,
+        test_y=test_labels,
     )
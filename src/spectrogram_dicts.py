@@ -1,7 +1,11 @@
+import hashlib
 import os
+import shutil
+
+import numpy as np
 
 import config
-from dev_data import df_dev
+from dev_data import LABEL_FILES, load_dev_labels
 from spectrograms import stft_matrix
 
 """
@@ -51,11 +55,72 @@ def build_class_dictionaries(dir_name):
     return depressed_dict, normal_dict
 
 
+def cached_class_dictionaries(dir_name):
+    """
+    Same as build_class_dictionaries, but the spectrograms are cached on disk
+    under dir_name/.cache. The cache is keyed on the no_silence wav files and
+    the label csv files (see cache_key), so it is rebuilt whenever either
+    changes, and older caches are removed. Cached matrices are memory-mapped
+    on load. Both dictionaries are ordered by participant id, so the cached
+    and freshly built dictionaries are identical.
+    """
+    cache_root = os.path.join(dir_name, ".cache")
+    cache_dir = os.path.join(cache_root, cache_key(dir_name))
+    if not os.path.isdir(cache_dir):
+        depressed_dict, normal_dict = build_class_dictionaries(dir_name)
+        tmp_dir = cache_dir + ".tmp"
+        os.makedirs(tmp_dir, exist_ok=True)
+        for prefix, class_dict in (("D", depressed_dict), ("N", normal_dict)):
+            for partic_id, mat in class_dict.items():
+                np.save(os.path.join(tmp_dir, f"{prefix}{partic_id}.npy"), mat)
+        os.replace(tmp_dir, cache_dir)
+        # drop the caches of previous inputs
+        with os.scandir(cache_root) as entries:
+            for entry in entries:
+                if entry.path != cache_dir:
+                    shutil.rmtree(entry.path)
+        return dict(sorted(depressed_dict.items())), dict(sorted(normal_dict.items()))
+
+    depressed_dict = dict()
+    normal_dict = dict()
+    with os.scandir(cache_dir) as entries:
+        for entry in entries:
+            mat = np.load(entry.path, mmap_mode="r")
+            partic_id = int(entry.name[1:-4])
+            if entry.name[0] == "D":
+                depressed_dict[partic_id] = mat
+            else:
+                normal_dict[partic_id] = mat
+    return dict(sorted(depressed_dict.items())), dict(sorted(normal_dict.items()))
+
+
+def cache_key(dir_name):
+    """
+    SHA-1 of the sorted (path, mtime, size) of the no_silence wav files in
+    dir_name, which build_class_dictionaries reads, and of the label csv
+    files, which decide the class of each participant.
+    """
+    files = list(LABEL_FILES)
+    for subdir, dirs, dir_files in os.walk(dir_name):
+        if ".cache" in dirs:
+            dirs.remove(".cache")
+        for file in dir_files:
+            if file.endswith("no_silence.wav"):
+                files.append(os.path.join(subdir, file))
+    entries = []
+    for file in files:
+        stat = os.stat(file)
+        relpath = os.path.relpath(file, config.BASE_DIR)
+        entries.append(f"{relpath}:{stat.st_mtime_ns}:{stat.st_size}")
+    return hashlib.sha1("\n".join(sorted(entries)).encode()).hexdigest()
+
+
 def in_dev_split(partic_id):
     """
     Returns True if the participant is in the AVEC development split
     (aka participant's we have depression labels for)
     """
+    df_dev = load_dev_labels()
     return partic_id in set(df_dev["Participant_ID"].values)
 
 
@@ -64,6 +129,7 @@ def get_depression_label(partic_id):
     Returns participant's PHQ8 Binary label. 1 representing depression;
     0 representing no depression.
     """
+    df_dev = load_dev_labels()
     return df_dev.loc[df_dev["Participant_ID"] == partic_id]["PHQ8_Binary"].item()
 
 